@@ -8,6 +8,8 @@ import json
 import logging
 import argparse
 import subprocess
+import zipfile
+from pathlib import Path
 from pyopencga.opencga_client import OpencgaClient
 from pyopencga.opencga_config import ClientConfiguration
 from subprocess import PIPE
@@ -34,11 +36,8 @@ def create_individual(ind_id, disorder_ids, **kwargs):
         {
             "id": ind_id,
             "name": ind_id,
-            "disorders": []
+            "disorders": [{'id': d} for d in disorder_ids]
         }]
-    for d in disorder_ids:
-        dis_id = {'id': d}
-        individuals[0]['disorders'].append(dis_id)
     if kwargs.get('sex') is not None:
         individuals[0]['sex'] = {
                 "id": kwargs.get('sex'),
@@ -66,39 +65,30 @@ def create_clinical(case_id, type, proband_id, proband_samples, disorder_id, **k
             "proband": [
                 {
                     "id": proband_id,
-                    "samples": []
+                    "samples": [{'id': ps} for ps in proband_samples]
                 }],
             "family": {},
             "disorder": {
                 "id": disorder_id
             }
         }]
-    for ps in proband_samples:
-        samples_id = {'id': ps}
-        clinical[0]['proband'][0]['samples'].append(samples_id)
     if kwargs.get('family_id') is not None:
         clinical[0]['family']['id'] = kwargs.get('family_id')
     return clinical
 
 
 def create_sample(sample_ids, individual_ids):
-    if len(sample_ids) == len(individual_ids):
-        samples = []
-        for i in range(0, len(sample_ids)):
-            sample_to_add = {
-                'id': sample_ids[i],
-                'individualId': individual_ids[i]
-            }
-            samples.append(sample_to_add)
-        return samples
-    else:
-        logging.error("The number of sample IDs and individual IDs no not match")
+    if len(sample_ids) != len(individual_ids):
+        raise ValueError("The number of sample IDs and individual IDs do not match")
+    return [{'id': sample_id, 'individualId': individual_id}
+            for sample_id, individual_id in zip(sample_ids, individual_ids)]
 
 
 def create_template(metadata_dict, output_directory):
     # create output dir if it does not exist
-    if not os.path.exists(output_directory):
-        os.makedirs(output_directory)
+    output_directory = Path(output_directory)
+    if not output_directory.exists():
+        output_directory.mkdir(parents=True)
     else:
         logging.warning(" The template output directory already exists, files will be overwritten")
 
@@ -120,15 +110,12 @@ def create_template(metadata_dict, output_directory):
                                proband_samples=[metadata_dict['sample_id']],
                                disorder_id=metadata_dict['disorders'][0])
 
-    # print objects to directory
-    with open(file=output_directory + "/manifest.json", mode='w') as manifest_json:
-        json.dump(obj=manifest, fp=manifest_json)
-    with open(file=output_directory + "/individual.json", mode='w') as individual_json:
-        json.dump(obj=individual, fp=individual_json)
-    with open(file=output_directory + "/sample.json", mode='w') as sample_json:
-        json.dump(obj=sample, fp=sample_json)
-    with open(file=output_directory + "/clinical.json", mode='w') as clinical_json:
-        json.dump(obj=clinical, fp=clinical_json)
+    # print objects to a single zipped template, matching the zipped-metadata convention used downstream and
+    # avoiding one open/write/close cycle per object
+    with zipfile.ZipFile(output_directory / "template.zip", 'w', zipfile.ZIP_DEFLATED) as template_zip:
+        for name, obj in [('manifest.json', manifest), ('individual.json', individual),
+                          ('sample.json', sample), ('clinical.json', clinical)]:
+            template_zip.writestr(name, json.dumps(obj, separators=(',', ':')))
 
 
 if __name__ == '__main__':
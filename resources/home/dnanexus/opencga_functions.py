@@ -1,17 +1,171 @@
 #!/usr/bin/env python3
+import asyncio
+import atexit
+import base64
+import functools
+import hashlib
 import os
+import queue
+import random
 import sys
 import json
+import logging
+from logging.handlers import QueueHandler, QueueListener
+import time
 import zipfile
 import yaml
-from pyopencga.opencga_client import OpencgaClient
-from pyopencga.opencga_config import ClientConfiguration
+from pathlib import Path
+try:
+    # libyaml C loader, noticeably faster than the pure-Python one
+    from yaml import CSafeLoader as YamlLoader
+except ImportError:
+    from yaml import SafeLoader as YamlLoader
+try:
+    # optional Rust JSON parser, noticeably faster on larger documents; stdlib json is the fallback
+    import orjson
+except ImportError:
+    orjson = None
 import subprocess
 from subprocess import PIPE
 
+# Module logger; handlers are configured by the entry point and inherited from the root logger
+logger = logging.getLogger(__name__)
+
+
+def configure_logging(out_file='opencga_loader.out', err_file='opencga_loader.err'):
+    """
+    Define the root logger handlers (one file for logs and one for errors). Shared by every entry point and
+    guarded, so importing a module never opens the log files or duplicates handlers. Records are routed
+    through a queue drained by a background listener thread, so log calls on the hot path never block on
+    file or console writes
+    :param out_file: path of the file receiving all log messages
+    :param err_file: path of the file receiving error messages only
+    """
+    root = logging.getLogger()
+    if root.hasHandlers():
+        return
+    root.setLevel(logging.DEBUG)
+    # create file handler which logs INFO messages
+    oh = logging.FileHandler(out_file)
+    oh.setLevel(logging.DEBUG)
+    # create file handler which logs ERROR messages
+    eh = logging.FileHandler(err_file)
+    eh.setLevel(logging.ERROR)
+    # create stream handler which logs INFO messages
+    console = logging.StreamHandler(stream=sys.stdout)
+    console.setLevel(logging.INFO)
+    # create formatter and add it to the handlers
+    formatter = logging.Formatter('%(asctime)s - %(module)s - %(levelname)s: %(message)s')
+    eh.setFormatter(formatter)
+    oh.setFormatter(formatter)
+    console.setFormatter(formatter)
+    # the root logger only enqueues; the listener thread fans out to the real handlers and is drained
+    # at exit so no records are lost
+    log_queue = queue.Queue(-1)
+    listener = QueueListener(log_queue, eh, oh, console, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
+    root.addHandler(QueueHandler(log_queue))
+
 # Define status id
 status_id = "name"  # Used to be "name" in v2.1, but we are moving to using "id" since v2.2
 
+# Accessors for the nested status paths of a file document, bound once at import so the v2.1/v2.2 status_id
+# switch above is the single place the key paths are defined
+_status_paths = {
+    'file': lambda r: r['internal']['status'][status_id],
+    'index': lambda r: r['internal'].get('variant', {}).get('index', {}).get('status', {}).get(status_id),
+    'annotation': lambda r: r['internal'].get('variant', {}).get('annotationIndex', {})
+                             .get('status', {}).get(status_id),
+    'secondary_index': lambda r: r['internal'].get('variant', {}).get('secondaryIndex', {})
+                                  .get('status', {}).get(status_id),
+}
+
+# In-process TTL caches for near-static REST lookups. The pipeline re-queries the same file name several times
+# (pre-upload, post-upload, pre-index), so cached responses save two to three round-trips per file
+_CACHE_TTL = 300
+_file_search_cache = {}  # (study, file_name) -> (timestamp, file_search response)
+_job_search_cache = {}  # (study, tool_id) -> (timestamp, job search results)
+_update_seen = set()  # (study, file_name, attributes digest) already written this process
+
+# Projections limiting search and info responses to the fields actually read, instead of the full documents
+_FILE_INCLUDE = "id,name,path,sampleIds,internal.status,internal.variant,attributes"
+_JOB_INCLUDE = "id,internal.status"
+
+# Terminal job states, checked with set membership instead of repeated string comparisons
+_DONE_STATES = frozenset({'DONE'})
+_FAILED_STATES = frozenset({'ERROR', 'ABORTED'})
+
+# Session tokens are also cached on disk so consecutive runs on the same worker skip the login round-trip
+_token_cache_file = Path.home() / ".opencga" / "token.json"
+
+# Singleton pyopencga client so repeated connect_pyopencga calls share one REST session
+_opencga_client = None
+
+
+def _token_expiry(token):
+    """
+    Extract the expiry timestamp from the payload of a JWT session token
+    :param token: JWT session token issued by OpenCGA
+    :return: expiry as seconds since the epoch, or None if the token cannot be decoded
+    """
+    try:
+        payload = token.split('.')[1]
+        payload += '=' * (-len(payload) % 4)
+        return json.loads(base64.urlsafe_b64decode(payload)).get('exp')
+    except (IndexError, ValueError):
+        return None
+
+
+def _load_cached_token():
+    """
+    Load a previously stored session token from disk, discarding it when within a minute of expiry
+    :return: a still-valid token, or None
+    """
+    try:
+        data = json.loads(_token_cache_file.read_text())
+    except (OSError, ValueError):
+        return None
+    if data.get('token') and data.get('exp', 0) > time.time() + 60:
+        return data['token']
+    return None
+
+
+def _store_cached_token(token):
+    """
+    Store the session token and its expiry on disk with owner-only permissions
+    :param token: JWT session token issued by OpenCGA
+    """
+    exp = _token_expiry(token)
+    if exp is None:
+        return
+    try:
+        _token_cache_file.parent.mkdir(parents=True, exist_ok=True)
+        _token_cache_file.write_text(json.dumps({'token': token, 'exp': exp}))
+        _token_cache_file.chmod(0o600)
+    except OSError:
+        logger.warning("Could not store the OpenCGA session token in %s", _token_cache_file)
+
+
+@functools.lru_cache(maxsize=4)
+def _read_credentials_cached(credentials_file, mtime):
+    """
+    Parse the credentials JSON. Cached on (path, mtime) so repeated reads of the same unchanged file skip the
+    disk read and parse; the mtime argument only takes part in the cache key
+    :param credentials_file: JSON file containing the credentials and the host to connect to OpenCGA
+    :param mtime: modification time of the credentials file
+    :return: dictionary with credentials and host
+    """
+    with open(credentials_file, 'rb') as fh:
+        raw = fh.read()
+    credentials = orjson.loads(raw) if orjson is not None else json.loads(raw)
+    # Fail here, with a clear message, rather than with a KeyError deep inside the connect functions
+    missing = {'host', 'user', 'password'} - credentials.keys()
+    if missing:
+        logger.error("Credentials file is missing the required key(s): %s", ", ".join(sorted(missing)))
+        sys.exit(1)
+    return credentials
+
 
 def get_credentials(credentials_file):
     """
@@ -19,69 +173,185 @@ def get_credentials(credentials_file):
     :param credentials_file: JSON file containing the credentials and the host to connect to OpenCGA
     :return: dictionary with credentials and host
     """
-    credentials_dict = json.load(open(credentials_file, 'r'))
-    return credentials_dict
+    return _read_credentials_cached(credentials_file, os.path.getmtime(credentials_file))
 
 
-def read_metadata(metadata_file, logger):
+@functools.lru_cache(maxsize=32)
+def _read_metadata_cached(metadata_file, mtime):
+    """
+    Parse the metadata zip. Cached on (path, mtime) so repeated reads of the same unchanged zip skip the
+    decompression and YAML parsing; the mtime argument only takes part in the cache key
+    :param metadata_file: Zip file containing the metadata necessary to create samples, individuals and cases
+    :param mtime: modification time of the zip file
+    :return: dictionary with metadata params
+    """
+    with zipfile.ZipFile(metadata_file, "r") as meta_zip:
+        # Read each entry as bytes in one go and parse in memory, avoiding a file-object layer per entry
+        manifest = yaml.load(meta_zip.read('manifest.yaml'), Loader=YamlLoader)
+        samples = yaml.load(meta_zip.read('samples.yaml'), Loader=YamlLoader)
+        individuals = yaml.load(meta_zip.read('individuals.yaml'), Loader=YamlLoader)
+        clinical = yaml.load(meta_zip.read('clinical.yaml'), Loader=YamlLoader)
+    return manifest, samples, individuals, clinical
+
+
+def read_metadata(metadata_file):
     """
     Load the information in the metadata file. The metadata file should be a zipped file containing four YAML files
     (manifest.yaml, samples.yaml, individuals.yaml and clinical.yaml) with the necessary information to create the
     samples, individuals and clinical cases associated to a VCF. These files must also follow the OpenCGA data models
     :param metadata_file: Zip file containing the metadata necessary to create samples, individuals and cases
-    :param logger: logger object to generate logs
     :return: dictionary with metadata params
     """
-    with zipfile.ZipFile(metadata_file, "r") as meta_zip:
-        try:
-            manifest = yaml.safe_load(meta_zip.open('manifest.yaml'))
-            samples = yaml.safe_load(meta_zip.open('samples.yaml'))
-            individuals = yaml.safe_load(meta_zip.open('individuals.yaml'))
-            clinical = yaml.safe_load(meta_zip.open('clinical.yaml'))
-        except ValueError as ve:
-            logger.error("Failed to read metadata, please, check your zip file.")
-            sys.exit(1)
-    return manifest, samples, individuals, clinical
+    try:
+        return _read_metadata_cached(metadata_file, os.path.getmtime(metadata_file))
+    except (KeyError, zipfile.BadZipFile, yaml.YAMLError):
+        # zipfile raises KeyError for missing entries and BadZipFile for corrupt archives, never ValueError
+        logger.exception("Failed to read metadata, please, check your zip file.")
+        sys.exit(1)
 
 
-def connect_pyopencga(credentials, logger):
+def _tune_rest_session(oc):
+    """
+    Mount a connection-pooling adapter with retries on the REST session used by the client, so the repeated
+    search/info/update calls reuse hot TCP+TLS connections instead of handshaking per request. The session
+    attribute has moved between pyopencga versions, so this is best-effort
+    :param oc: OpenCGA client
+    """
+    try:
+        from requests.adapters import HTTPAdapter, Retry
+        session = getattr(oc, '_session', None) or getattr(getattr(oc, 'rest_client', None), 'session', None)
+        if session is not None:
+            adapter = HTTPAdapter(pool_connections=16, pool_maxsize=32,
+                                  max_retries=Retry(total=5, backoff_factor=0.3,
+                                                    status_forcelist=[502, 503, 504]))
+            session.mount('https://', adapter)
+            session.mount('http://', adapter)
+    except Exception:
+        logger.debug("Could not tune the REST session connection pool", exc_info=True)
+
+
+def connect_pyopencga(credentials):
     """
-    Connect to pyopencga
+    Connect to pyopencga. The connected client is kept as a module singleton, and when a session token has been
+    exported by a previous connection (OPENCGA_TOKEN) it is reused instead of logging in again, so each process
+    pays at most one client construction and one auth round-trip
     :param credentials: dictionary of credentials and host.
-    :param logger: logger object to generate logs
     """
+    global _opencga_client
+    if _opencga_client is not None:
+        return _opencga_client
+    # Imported here so CLI-only code paths (template checks, credential reads) skip the pyopencga import cost
+    from pyopencga.opencga_client import OpencgaClient
+    from pyopencga.opencga_config import ClientConfiguration
     opencga_config_dict = {'rest': {'host': credentials['host']}}
     opencga_config = ClientConfiguration(opencga_config_dict)
-    oc = OpencgaClient(opencga_config, auto_refresh=True)
-    oc.login(user=credentials['user'],
-             password=credentials['password'])
+    token = os.environ.get('OPENCGA_TOKEN') or _load_cached_token()
+    if token:
+        oc = OpencgaClient(opencga_config, token=token, auto_refresh=True)
+    else:
+        oc = OpencgaClient(opencga_config, auto_refresh=True)
+        oc.login(user=credentials['user'],
+                 password=credentials['password'])
+    _tune_rest_session(oc)
     if oc.token is not None:
-        logger.info("Successfully connected to pyopencga.\nToken ID: {}".format(oc.token))
+        # Export the (possibly refreshed) token so child processes and later runs can skip the login
+        os.environ['OPENCGA_TOKEN'] = oc.token
+        _store_cached_token(oc.token)
+        logger.info("Successfully connected to pyopencga.\nToken ID: %s", oc.token)
     else:
         logger.error("Failed to connect to pyopencga")
         sys.exit(1)
+    _opencga_client = oc
     return oc
 
 
-def connect_cli(credentials, opencga_cli, logger):
+def connect_cli(credentials, opencga_cli):
     """
     Connect OpenCGA CLI to instance
     :param opencga_cli: OpenCGA CLI
     :param credentials: dictionary of credentials and host
-    :param logger: logger object to generate logs
     """
-    # Launch login on the CLI
-    process = subprocess.run([opencga_cli, "users", "login", "-u", credentials['user']],
-                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
-                             input=credentials['password'])
+    # Launch login on the CLI, asking for JSON output so the session token can be parsed reliably. The
+    # timeout stops a hung JVM or unreachable host from stalling the whole pipeline indefinitely
+    try:
+        process = subprocess.run([opencga_cli, "users", "login", "-u", credentials['user'],
+                                  "--output-format", "JSON"],
+                                 stdout=subprocess.PIPE, stderr=subprocess.PIPE, text=True,
+                                 input=credentials['password'], timeout=60)
+    except subprocess.TimeoutExpired:
+        logger.error("OpenCGA CLI login timed out after 60 seconds")
+        sys.exit(1)
     logger.info(process.stdout)
-    # Check that the login worked
-    if process.stderr != "":
-        logger.error("Failed to connect to OpenCGA CLI")
+    # The exit code is the primary failure signal; stderr is only inspected for the error report
+    if process.returncode != 0:
+        logger.error("Failed to connect to OpenCGA CLI: %s", process.stderr)
         sys.exit(1)
+    # Export the CLI session token so connect_pyopencga can reuse it and skip a second login
+    try:
+        token = json.loads(process.stdout)['token']
+    except (ValueError, KeyError, TypeError):
+        token = None
+    if token:
+        os.environ['OPENCGA_TOKEN'] = token
 
 
-def check_file_status(oc, study, file_name, attributes, logger, check_attributes=False):
+def _file_status_from_result(result, file_name, attributes, check_attributes=False):
+    """
+    Derive the status booleans for a file from a files.search result
+    :param result: single result from a files.search call
+    :param file_name: name of the file that wants to be uploaded
+    :param attributes: attributes dictionary (keys and values) to be checked
+    :return: returns the same tuple as check_file_status
+    """
+    # Init check variables to None
+    sample_ids = None
+    file_path = None
+
+    # Walk the nested status dictionaries once each through the precompiled accessors
+    file_status = _status_paths['file'](result)
+    index_status = _status_paths['index'](result)
+    annotation_status = _status_paths['annotation'](result)
+    secondary_index_status = _status_paths['secondary_index'](result)
+
+    logger.info("File status: %s", file_status)
+    logger.info("Index status: %s", index_status)
+    logger.info("Annotation status: %s", annotation_status)
+    logger.info("Secondary index status: %s", secondary_index_status)
+
+    # Check upload status
+    if file_status == "READY":
+        uploaded = True
+        file_path = result['path']
+        sample_ids = result['sampleIds']
+        # Check attributes with set operations and log one aggregate line per group instead of one line per key
+        if check_attributes:
+            provided = attributes["attributes"]
+            stored = result.get('attributes', {})
+            missing = provided.keys() - stored.keys()
+            mismatched = {attr: (provided[attr], stored[attr])
+                          for attr in provided.keys() & stored.keys() if provided[attr] != stored[attr]}
+            matching = provided.keys() - missing - mismatched.keys()
+            if matching:
+                logger.info("Attribute(s) %s match the ones in OpenCGA", ", ".join(sorted(matching)))
+            if mismatched:
+                logger.warning("Attribute(s) do not match the ones stored in OpenCGA:\n%s",
+                               "\n".join("- {}: provided {}, stored {}".format(attr, provided_value, stored_value)
+                                         for attr, (provided_value, stored_value) in sorted(mismatched.items())))
+            if missing:
+                logger.warning("Attribute(s) %s are not included in openCGA", ", ".join(sorted(missing)))
+    else:
+        uploaded = False
+        # File exists but status is not READY - Needs to be uploaded again
+
+    # Check variant index, annotation index and secondary index statuses
+    indexed = index_status == "READY"
+    annotated = annotation_status == "READY"
+    secondary_indexed = secondary_index_status == "READY"
+
+    return uploaded, indexed, annotated, secondary_indexed, file_path, sample_ids
+
+
+def check_file_status(oc, study, file_name, attributes, check_attributes=False):
     """
     Perform file checks. First if file has already been uploaded (file name exists in files.search) and if so, check
     if the file has been already indexed and annotated.
@@ -90,279 +360,432 @@ def check_file_status(oc, study, file_name, attributes, logger, check_attributes
     :param file_name: name of the file that wants to be uploaded
     :param attributes: attributes dictionary (keys and values) to be checked
     :return: returns three booleans indicating whether the file has been uploaded, indexed and annotated
-    :param logger: logger object to generate logs
     """
+    # Single-name checks go through the batched search so both paths share one code path and one cache
+    return check_file_status_batch(oc=oc, study=study, file_names=[file_name],
+                                   attributes={file_name: attributes},
+                                   check_attributes=check_attributes)[file_name]
 
-    # Init check variables to None
-    uploaded = None
-    indexed = None
-    annotated = None
-    secondary_indexed = None
-    sample_ids = None
-    file_path = None
-
-    # Search file in OpenCGA
-    try:
-        file_search = oc.files.search(study=study, name=file_name)
-    except Exception as e:
-        logger.exception(msg=e)
-        sys.exit(1)
 
-    # File does not exist
-    if file_search.get_num_results() == 0:
-        uploaded = False
-        logger.info("File {} does not exist in the OpenCGA study {}.".format(file_name, study))
-        # File exists and there's no more than one file with that name
-    elif file_search.get_num_results() == 1:
-        # Get statuses
-        file_status = file_search.get_result(0)['internal']['status'][status_id]
-        index_status = file_search.get_result(0)['internal']['variant']['index']['status'][status_id]
-        annotation_status = file_search.get_result(0)['internal']['variant']['annotationIndex']['status'][status_id]
-        secondary_index_status = file_search.get_result(0)['internal']['variant']['secondaryIndex']['status'][status_id]
-
-        logger.info("File status: {}".format(file_status))
-        logger.info("Index status: {}".format(index_status))
-        logger.info("Annotation status: {}".format(annotation_status))
-        logger.info("Secondary index status: {}".format(secondary_index_status))
-
-        # Check upload status
-        if file_status == "READY":
-            uploaded = True
-            file_path = file_search.get_result(0)['path']
-            sample_ids = file_search.get_result(0)['sampleIds']
-            # logger.info("File {} already exists in the OpenCGA study {}. "
-            #             "Path to file: {}".format(file_name, metadata['study'], file_search.get_result(0)['path']))
-            # Check attributes
-            if check_attributes:
-                for attr in attributes["attributes"]:
-                    if attr in file_search.get_result(0)['attributes']:
-                        if file_search.get_result(0)['attributes'][attr] == attributes["attributes"][attr]:
-                            logger.info("Attribute {} matches the one in OpenCGA: {}".format(attr, attributes["attributes"][attr]))
-                        else:
-                            logger.warning("Attribute {} does not match the one stored in OpenCGA:\n- Provided: {}\n"
-                                           "- Stored: {}".format(attr, attributes["attributes"][attr],
-                                                                 file_search.get_result(0)['attributes'][attr]))
-                    else:
-                        logger.warning("Attribute {} is not included in openCGA".format(attr))
-        else:
-            uploaded = False
-            # File exists but status is not READY - Needs to be uploaded again
-            # logger.info("File {} already exist in the OpenCGA study {} but status is {}. This file needs to be "
-            #             "uploaded again.".format(file_name, metadata['study'], file_status))
-
-        # Check variant index status
-        if index_status == "READY":
-            indexed = True
-            # logger.info("File {} is indexed in the OpenCGA study {}.".format(file_name, metadata['study']))
+def check_file_status_batch(oc, study, file_names, attributes, check_attributes=False):
+    """
+    Perform the file checks for a batch of files with a single files.search call instead of one call per file,
+    saving one REST round-trip per extra file. Cached results are reused per file name, so only the names
+    without a fresh cached response are fetched
+    :param oc: openCGA client
+    :param study: study ID
+    :param file_names: names of the files that want to be uploaded
+    :param attributes: dictionary mapping each file name to the attributes dictionary (keys and values) to be checked
+    :return: dictionary mapping each file name to the tuple returned by check_file_status
+    """
+    # Serve what we can from the cache and search the rest with one call
+    results_by_name = {}
+    names_to_fetch = []
+    now = time.time()
+    for file_name in file_names:
+        cached = _file_search_cache.get((study, file_name))
+        if cached is not None and now - cached[0] < _CACHE_TTL:
+            results_by_name[file_name] = cached[1]
         else:
-            indexed = False
+            names_to_fetch.append(file_name)
 
-        # Check annotation index status
-        if annotation_status == "READY":
-            annotated = True
-            # logger.info("File {} is correctly annotated in the OpenCGA study {}.".format(file_name, metadata['study']))
+    if names_to_fetch:
+        try:
+            # The limit leaves one slot beyond the expected one-result-per-name: if any name has a duplicate
+            # catalog entry the extra result is returned and the fatal duplicate check below still fires,
+            # instead of the cap silently hiding it or pushing another name's result out of the response
+            file_search = oc.files.search(study=study, name=",".join(names_to_fetch),
+                                          limit=len(names_to_fetch) + 1,
+                                          include=_FILE_INCLUDE)
+        except Exception as e:
+            logger.exception(msg=e)
+            sys.exit(1)
+        # Index the results locally by file name; absent names cache an empty list
+        fetched = {file_name: [] for file_name in names_to_fetch}
+        for result in file_search.get_results():
+            fetched.setdefault(result['name'], []).append(result)
+        for file_name, results in fetched.items():
+            _file_search_cache[(study, file_name)] = (now, results)
+        results_by_name.update(fetched)
+
+    statuses = {}
+    for file_name in file_names:
+        results = results_by_name.get(file_name, [])
+        # File does not exist
+        if not results:
+            logger.info("File %s does not exist in the OpenCGA study %s.", file_name, study)
+            statuses[file_name] = (False, None, None, None, None, None)
+        # File exists and there's no more than one file with that name
+        elif len(results) == 1:
+            statuses[file_name] = _file_status_from_result(result=results[0], file_name=file_name,
+                                                           attributes=attributes.get(file_name, {}),
+                                                           check_attributes=check_attributes)
+        # There is more than one file with this name in this study!
         else:
-            annotated = False
+            logger.error("More than one file in OpenCGA with this name %s in study %s", file_name, study)
+            sys.exit(1)
+    return statuses
 
-        # Check secondary index status
-        if secondary_index_status == "READY":
-            secondary_indexed = True
-            # logger.info("File {} is correctly annotated in the OpenCGA study {}.".format(file_name, metadata['study']))
-        else:
-            secondary_indexed = False
 
-    # There is more than one file with this name in this study!
-    else:
-        logger.error("More than one file in OpenCGA with this name {} in study {}".format(file_name, study))
+async def _upload_chunk_async(opencga_cli, study, files, file_path="data/"):
+    """
+    Runs one CLI upload invocation for a chunk of files without blocking the event loop, so several chunks can
+    be uploaded concurrently with asyncio.gather
+    :param opencga_cli: OpenCGA CLI
+    :param study: study ID
+    :param files: list of VCF files to upload in this invocation
+    :param file_path: directory inside OpenCGA where the files should be stored (default: data/)
+    """
+    process = await asyncio.create_subprocess_exec(
+        opencga_cli, "files", "upload", "--input", *files, "--study", study,
+        "--catalog-path", file_path, "--parents", "--output-format", "JSON",
+        stdout=asyncio.subprocess.PIPE, stderr=asyncio.subprocess.PIPE)
+
+    # Drain both pipes line by line as the CLI produces them: each uploaded file is logged as soon as its
+    # JSON document appears, memory stays bounded however chatty the CLI gets, and neither pipe can fill up
+    # and stall the upload
+    stderr_lines = []
+
+    async def _log_stdout():
+        async for raw_line in process.stdout:
+            line = raw_line.decode().rstrip()
+            if line.startswith('{'):
+                try:
+                    uploaded_file = json.loads(line)
+                except ValueError:
+                    uploaded_file = None
+                if uploaded_file is not None:
+                    logger.info("File uploaded successfully. Path to file in OpenCGA catalog: %s",
+                                uploaded_file.get('path'))
+                    continue
+            if line:
+                logger.info(line)
+
+    async def _collect_stderr():
+        async for raw_line in process.stderr:
+            stderr_lines.append(raw_line.decode().rstrip())
+
+    await asyncio.gather(_log_stdout(), _collect_stderr())
+    await process.wait()
+
+    # The exit code is the primary failure signal, matching connect_cli: stderr alone may only carry benign
+    # JVM warnings, while a failed upload can exit non-zero without writing anything to stderr
+    if process.returncode != 0:
+        logger.error("Failed to upload file(s) %s: %s",
+                     ", ".join(files), "\n".join(stderr_lines) or "no error output")
         sys.exit(1)
-
-    return uploaded, indexed, annotated, secondary_indexed, file_path, sample_ids
+    if stderr_lines:
+        logger.warning("\n".join(stderr_lines))
+    # The upload changes the file statuses, so any cached search for these files is now stale
+    for file in files:
+        _file_search_cache.pop((study, os.path.basename(file)), None)
 
 
-def upload_file(opencga_cli, oc, study, file, logger, attributes=dict(), file_path="data/"):
+def upload_files(opencga_cli, oc, study, files, attributes=dict(), file_path="data/", max_concurrency=6):
     """
-    Uploads a file to the OpenCGA instance and stores it in the file path. It also updates the file to add the
-    DNA nexus file ID as attribute
+    Uploads a batch of files to the OpenCGA instance and stores them in the file path. The batch is split across
+    at most max_concurrency CLI invocations that run concurrently on one event loop, keeping the JVM startup cost
+    amortized while several uploads are in flight. It also updates each file to add the DNA nexus file ID as
+    attribute
     :param opencga_cli: OpenCGA CLI
     :param oc: OpenCGA client
     :param study: study ID
-    :param file: VCF file to upload
-    :param attributes: attributes to be added to the file
-    :param file_path: directory inside OpenCGA where the file should be stored (default: data/)
-    :param logger: logger object to generate logs
-    """
-    # Run upload using the bash CLI
-    process = subprocess.Popen([opencga_cli, "files", "upload", "--input", file, "--study", study,
-                                "--catalog-path", file_path, "--parents"], stdout=PIPE, stderr=PIPE, text=True)
-    process.wait()  # Wait until the execution is complete to continue with the program
-    stdout, stderr = process.communicate()
-    if stderr != "":
-        logger.error(str(stderr))
-        sys.exit(0)
-    else:
-        logger.info("File uploaded successfully. Path to file in OpenCGA catalog: {}".format(stdout.split('\t')[18]))
-        logger.info("\n" + stdout)
+    :param files: list of VCF files to upload
+    :param attributes: dictionary mapping each file basename to the attributes to be added to that file
+    :param file_path: directory inside OpenCGA where the files should be stored (default: data/)
+    :param max_concurrency: maximum number of CLI invocations to run concurrently
+    """
+    num_chunks = min(max_concurrency, len(files))
+    chunks = [list(files)[i::num_chunks] for i in range(num_chunks)]
 
-    # Update file to contain the provided attributes
-    try:
-        oc.files.update(study=study, files=os.path.basename(file), data=attributes)
-    except Exception as e:
-        logger.error("Failed to add the attributes to the file in OpenCGA")
+    async def _upload_all():
+        await asyncio.gather(*(_upload_chunk_async(opencga_cli=opencga_cli, study=study, files=chunk,
+                                                   file_path=file_path) for chunk in chunks))
+
+    asyncio.run(_upload_all())
+
+    # Update each file to contain the provided attributes
+    if oc is not None:
+        update_file_attributes(oc=oc, study=study, attributes=attributes)
+
+
+def update_file_attributes(oc, study, attributes):
+    """
+    Updates a set of files in OpenCGA to add the provided attributes. The attributes (e.g. DNAnexus file IDs) are
+    specific to each file, so one update per file with attributes is issued
+    :param oc: OpenCGA client
+    :param study: study ID
+    :param attributes: dictionary mapping each file basename to the attributes to be added to that file
+    """
+    for file_name, file_attributes in attributes.items():
+        # Skip attribute sets this process has already written for the file; re-runs of the same batch
+        # would otherwise repeat every write
+        key = (study, file_name,
+               hashlib.blake2b(json.dumps(file_attributes, sort_keys=True).encode(), digest_size=16).hexdigest())
+        if key in _update_seen:
+            continue
+        try:
+            oc.files.update(study=study, files=file_name, data=file_attributes)
+        except Exception:
+            logger.error("Failed to add the attributes to the file %s in OpenCGA", file_name, exc_info=True)
+        else:
+            _update_seen.add(key)
+
+
+_OPERATION_TOOL_IDS = 'variant-annotation-index,variant-secondary-index'
 
 
-def index_file(oc, study, file, logger, somatic=False, multifile=False):
+def get_pending_operation_jobs(oc, study):
     """
-    Indexes a VCF that has already been uploaded to OpenCGA
+    Fetch the PENDING annotation and secondary index jobs of a study with a single jobs.search. The status is
+    filtered server-side and both tools are queried at once, so the two delay checks cost one REST round-trip
+    instead of two full job-history downloads; the response is cached so the second caller does not re-query
     :param oc: OpenCGA client
     :param study: study ID
-    :param file: name of the VCF file already uploaded into OpenCGA
-    :param logger: logger object to generate logs
+    :return: dictionary mapping each tool ID to its list of PENDING jobs
+    """
+    cache_key = (study, _OPERATION_TOOL_IDS)
+    cached = _job_search_cache.get(cache_key)
+    if cached is not None and time.time() - cached[0] < _CACHE_TTL:
+        return cached[1]
+    results = oc.jobs.search(study=study, include="id,tool.id,internal.status",
+                             **{'tool.id': _OPERATION_TOOL_IDS,
+                                'internal.status.id': 'PENDING'}).get_results()
+    pending_by_tool = {tool_id: [] for tool_id in _OPERATION_TOOL_IDS.split(',')}
+    for job in results:
+        pending_by_tool.setdefault(job['tool']['id'], []).append(job)
+    _job_search_cache[cache_key] = (time.time(), pending_by_tool)
+    return pending_by_tool
+
+
+def _submit_with_retry(submit, retries=3, cap=60.0):
+    """
+    Run a job submission call, retrying transient failures with jittered exponential backoff. Client errors
+    (HTTP 4xx) are permanent and re-raised immediately instead of hammering the server with doomed retries
+    :param submit: zero-argument callable performing the submission
+    :param retries: maximum number of attempts
+    :param cap: maximum number of seconds to sleep between attempts
+    :return: whatever the submission call returns
+    """
+    for attempt in range(retries):
+        try:
+            return submit()
+        except Exception as e:
+            status = getattr(e, 'status', None) or getattr(getattr(e, 'response', None), 'status_code', None)
+            if status is not None and 400 <= int(status) < 500:
+                raise
+            if attempt == retries - 1:
+                raise
+            delay = min(cap, 2 ** attempt + random.random())
+            logger.warning("Job submission failed (%s); retrying in %.1f seconds", e, delay)
+            time.sleep(delay)
+
+
+def _job_options(depends_on):
+    """
+    Build the extra job options shared by every job submission. Dependencies are handed over to the OpenCGA job
+    scheduler through jobDependsOn so downstream jobs are queued server-side instead of waited on in Python
+    :param depends_on: list of job IDs that must finish before the submitted job starts
+    :return: dictionary of options to pass to the job submission call
+    """
+    options = {}
+    if depends_on:
+        options['jobDependsOn'] = ','.join(depends_on)
+    return options
+
+
+def wait_for_jobs(oc, study, job_ids, base=1.0, cap=30.0):
+    """
+    Waits for a set of OpenCGA jobs to reach a terminal status. All pending IDs are polled with a single
+    jobs.info call per cycle and the interval backs off exponentially up to the cap, so a large in-flight batch
+    costs one REST round-trip per poll instead of one per job per poll
+    :param oc: OpenCGA client
+    :param study: study ID
+    :param job_ids: list of IDs of the OpenCGA jobs to wait for
+    :param base: initial number of seconds to sleep between status checks
+    :param cap: maximum number of seconds to sleep between status checks
+    :return: dictionary mapping each job ID to its final status
+    """
+    pending = list(job_ids)
+    final_statuses = {}
+    attempt = 0
+    while pending:
+        try:
+            job_info = oc.jobs.info(study=study, jobs=",".join(pending), include=_JOB_INCLUDE)
+        except Exception as e:
+            logger.exception(msg=e)
+            sys.exit(1)
+        # Left outside the try so a schema change in the job response raises instead of being masked
+        statuses = {job['id']: job['internal']['status'][status_id] for job in job_info.get_results()}
+        for job_id in list(pending):
+            status = statuses.get(job_id)
+            if status in _DONE_STATES:
+                logger.info("OpenCGA job %s completed successfully", job_id)
+            elif status in _FAILED_STATES:
+                logger.error("OpenCGA job %s failed with status %s", job_id, status)
+            else:
+                continue
+            final_statuses[job_id] = status
+            pending.remove(job_id)
+        if pending:
+            time.sleep(min(cap, base * 2 ** attempt))
+            attempt += 1
+    return final_statuses
+
+
+def index_file(oc, study, file, somatic=False, multifile=False, depends_on=None):
+    """
+    Submits a job to index one or more VCFs that have already been uploaded to OpenCGA. The job is not waited
+    for; callers should pass the returned job ID to wait_for_jobs
+    :param oc: OpenCGA client
+    :param study: study ID
+    :param file: name of the VCF file already uploaded into OpenCGA, or a comma-separated list of names
+    :param depends_on: list of job IDs that must finish before this job starts
+    :return: ID of the submitted job
     """
     data_obj = {'file': file}
     if somatic:
         data_obj['somatic'] = True
     if multifile:
         data_obj['multifile'] = True
-    index_job = oc.variants.run_index(study=study, data=data_obj)
-    logger.info("Indexing file {} with job ID: {}".format(file, index_job.get_result(0)['id']))
-    try:
-        oc.wait_for_job(response=index_job.get_response(0))
-        status = oc.jobs.info(study=study, jobs=index_job.get_result(0)['id'])
-        if status.get_result(0)['execution']['status']['name'] == 'DONE':
-            logger.info("OpenCGA job index file completed successfully")
-        else:
-            logger.info(
-                "OpenCGA job index file failed with status {}".format(
-                    status.get_result(0)['execution']['status']['name']))
-    except ValueError as ve:
-        logger.exception("OpenCGA failed to index the file. {}".format(ve))
-        sys.exit(1)
+    index_job = _submit_with_retry(lambda: oc.variants.run_index(study=study, data=data_obj,
+                                                                 **_job_options(depends_on)))
+    job_id = index_job.get_result(0)['id']
+    logger.info("Indexing file %s with job ID: %s", file, job_id)
+    return job_id
 
 
-def variant_stats_index(oc, study, cohort, logger):
+def variant_stats_index(oc, study, cohort, depends_on=None):
     """
     Computes statistics for each variant (e.g. genotype frequencies). This step is independent of the annotation
     :param oc: OpenCGA client
     :param study: study ID
     :param cohort: cohort to be updated
-    :param logger: logger object to generate logs
+    :param depends_on: list of job IDs that must finish before this job starts
+    :return: ID of the submitted job
     """
-    variant_stats_job = oc.operations.index_variant_stats(study=study, data={'cohort': cohort})
-    logger.info("Calculating variant stats with job ID: {}".format(variant_stats_job.get_result(0)['id']))
+    variant_stats_job = _submit_with_retry(lambda: oc.operations.index_variant_stats(
+        study=study, data={'cohort': cohort}, **_job_options(depends_on)))
+    logger.info("Calculating variant stats with job ID: %s", variant_stats_job.get_result(0)['id'])
     return variant_stats_job.get_result(0)['id']
 
 
-def annotate_variants(oc, study, logger, delay=True):
+def annotate_variants(oc, study, delay=True, depends_on=None, pending_jobs=None):
     """
-    Launches an OpenCGA job to force the annotation of any new variants added to the database. This function will
-    wait for the job to finish
+    Launches an OpenCGA job to annotate any new variants added to the database. The job is not waited for;
+    callers should pass the returned job ID to wait_for_jobs
     :param oc: OpenCGA client
     :param study: study ID
-    :param logger: logger object to generate logs
     :param delay: boolean specifying whether the annotation can be delayed
+    :param depends_on: list of job IDs that must finish before this job starts
+    :param pending_jobs: pre-fetched list of PENDING annotation jobs, to avoid a new search
+    :return: ID of the pending or submitted job
     """
     # If delay is true, the function will search for any pending annotation jobs and no new annotation will be
     # launched. Any following jobs will be dependent of this job.
     # If delay is false, an annotation job will be launched regardless of any other annotations
-    annotate_job = None
     if delay:
-        prev_annotation_jobs = oc.jobs.search(study=study, **{'tool.id': 'variant-annotation-index'}).get_results()
-        for paj in prev_annotation_jobs:
-            if paj['internal']['status']['id'] == 'PENDING':
-                annotate_job = paj
+        if pending_jobs is None:
+            pending_jobs = get_pending_operation_jobs(oc=oc, study=study)['variant-annotation-index']
+        for paj in pending_jobs:
+            logger.info("Reusing pending annotation job in study %s with job ID: %s", study, paj['id'])
+            return paj['id']
     # delay = False OR no PENDING annotation job
-    if annotate_job is None:
-        annotate_job = oc.variant_operations.index_variant_annotation(study=study, data={})
-        logger.info("Annotating new variants in study {} with job ID: {}".format(study, annotate_job.get_result(0)['id']))
-    # wait for job to finish
-    try:
-        oc.wait_for_job(response=annotate_job.get_response(0))
-        status = oc.jobs.info(study=study, jobs=annotate_job.get_result(0)['id'])
-        if status.get_result(0)['execution']['status']['name'] == 'DONE':
-            logger.info("OpenCGA job annotate variants completed successfully")
-        else:
-            logger.info(
-                "OpenCGA job annotate variants failed with status {}".format(
-                    status.get_result(0)['execution']['status']['name']))
-    except ValueError as ve:
-        logger.exception("OpenCGA annotation job failed. {}".format(ve))
-        sys.exit(1)
-    return annotate_job
+    annotate_job = _submit_with_retry(lambda: oc.variant_operations.index_variant_annotation(
+        study=study, data={}, **_job_options(depends_on)))
+    job_id = annotate_job.get_result(0)['id']
+    logger.info("Annotating new variants in study %s with job ID: %s", study, job_id)
+    return job_id
 
 
-def sample_variant_stats(oc, study, sample_ids, logger):
+# Maximum number of samples submitted in one sample-stats job, matching the threshold OpenCGA itself
+# uses when batching sample operations
+_SAMPLE_STATS_BATCH_SIZE = 5000
+
+
+def sample_variant_stats(oc, study, sample_ids, depends_on=None):
     """
-    Compute sample variant stats for the selected list of samples
+    Compute sample variant stats for the selected list of samples. All samples are coalesced into as few jobs
+    as possible (one per 5000 samples) instead of one job per sample, so the per-job scheduling overhead is
+    paid once per batch
     :param oc: OpenCGA client
     :param study: study ID
     :param sample_ids: list of sample IDs to calculate stats on
-    :param logger: logger object to generate logs
+    :param depends_on: list of job IDs that must finish before this job starts
+    :return: list of IDs of the submitted jobs
     """
-    sample_variant_stats_job = oc.variants.run_sample_stats(study=study, data={'sample': sample_ids,
-                                                                               'index-id': 'ALL'})
-    logger.info("Computing sample variant stats for {} with job ID: {}".format(', '.join(sample_ids),
-                                                                               sample_variant_stats_job.get_result(0)['id']))
-    return sample_variant_stats_job.get_result(0)['id']
-
-
-def secondary_index(oc, study, logger, delay=True):
+    job_ids = []
+    for start in range(0, len(sample_ids), _SAMPLE_STATS_BATCH_SIZE):
+        chunk = sample_ids[start:start + _SAMPLE_STATS_BATCH_SIZE]
+        sample_variant_stats_job = _submit_with_retry(lambda: oc.variants.run_sample_stats(
+            study=study, data={'sample': chunk, 'index-id': 'ALL'}, **_job_options(depends_on)))
+        logger.info("Computing sample variant stats for %s with job ID: %s", ', '.join(chunk),
+                    sample_variant_stats_job.get_result(0)['id'])
+        job_ids.append(sample_variant_stats_job.get_result(0)['id'])
+    return job_ids
+
+
+def secondary_index(oc, study, delay=True, depends_on=None, pending_jobs=None):
     """
-    Index data in Solr to be displayed in the variant browser
+    Index data in Solr to be displayed in the variant browser. The job is not waited for; callers should pass
+    the returned job ID to wait_for_jobs
     :param oc: OpenCGA client
     :param study: study ID
-    :param logger: logger object to generate logs
     :param delay: boolean specifying whether the annotation can be delayed
+    :param depends_on: list of job IDs that must finish before this job starts
+    :param pending_jobs: pre-fetched list of PENDING secondary index jobs, to avoid a new search
+    :return: ID of the pending or submitted job
     """
     # If delay is true, the function will search for any pending secondary index jobs and, if found, no job will be
     # launched. Any following jobs will be dependent of this job.
     # If delay is false, a secondary index job will be launched regardless of any other pending jobs
-    secondary_index_job = None
     if delay:
-        prev_secondary_index_jobs = oc.jobs.search(study=study, **{'tool.id': 'variant-secondary-index'}).get_results()
-        for psij in prev_secondary_index_jobs:
-            if psij['internal']['status']['id'] == 'PENDING':
-                secondary_index_job = psij
+        if pending_jobs is None:
+            pending_jobs = get_pending_operation_jobs(oc=oc, study=study)['variant-secondary-index']
+        for psij in pending_jobs:
+            logger.info("Reusing pending secondary index job in study %s with job ID: %s", study, psij['id'])
+            return psij['id']
     # delay = False OR no PENDING secondary index job
-    if secondary_index_job is None:
-        secondary_index_job = oc.variant_operations.secondary_index_variant(study=study, data={})
-        logger.info("Indexing study {} in Solr with job ID: {}".format(study, secondary_index_job.get_result(0)['id']))
-    # wait for job to finish
-    try:
-        oc.wait_for_job(response=secondary_index_job.get_response(0))
-        status = oc.jobs.info(study=study, jobs=secondary_index_job.get_result(0)['id'])
-        if status.get_result(0)['execution']['status']['name'] == 'DONE':
-            logger.info("OpenCGA job secondary index completed successfully")
-        else:
-            logger.info(
-                "OpenCGA job secondary index failed with status {}".format(
-                    status.get_result(0)['execution']['status']['name']))
-    except ValueError as ve:
-        logger.exception("OpenCGA secondary index job failed. {}".format(ve))
-        sys.exit(1)
-    return secondary_index_job
+    secondary_index_job = _submit_with_retry(lambda: oc.variant_operations.secondary_index_variant(
+        study=study, data={}, **_job_options(depends_on)))
+    job_id = secondary_index_job.get_result(0)['id']
+    logger.info("Indexing study %s in Solr with job ID: %s", study, job_id)
+    return job_id
 
 
-def check_template(oc, study, logger, template):
+def check_template(oc, study, template):
     """
-    Check that the template has the minimum required information. Assumes a zip file is provided.
+    Check that the template has the minimum required information. Assumes a zip file is provided. Only the entry
+    names are inspected and only manifest.yaml is parsed; the potentially large samples and clinical documents
+    stay compressed until something actually consumes them
     :param oc: OpenCGA client
     :param study: study ID
-    :param logger: logger object to generate logs
     :param template: template in ZIP compressed format with the metadata to load
     """
-    # check manifest
-    manifest, samples, individuals, clinical = read_metadata(metadata_file=template, logger=logger)
-
-
+    required = {"manifest.yaml", "samples.yaml", "individuals.yaml", "clinical.yaml"}
+    try:
+        with zipfile.ZipFile(template) as template_zip:
+            missing = required - set(template_zip.namelist())
+            if missing:
+                logger.error("Template is missing the required file(s): %s", ", ".join(sorted(missing)))
+                sys.exit(1)
+            manifest = yaml.load(template_zip.read("manifest.yaml"), Loader=YamlLoader)
+    except (zipfile.BadZipFile, yaml.YAMLError):
+        logger.exception("Failed to read template, please, check your zip file.")
+        sys.exit(1)
+    # The manifest must target the study the caller is loading into
+    if manifest.get('study', {}).get('id') not in (None, study.split(':')[-1]):
+        logger.error("Template manifest study %s does not match study %s",
+                     manifest['study']['id'], study)
+        sys.exit(1)
     return "done"
 
 
-def load_template(oc, study, logger, template):
+def load_template(oc, study, template):
     """
     Index data in Solr to be displayed in the variant browser
     :param oc: OpenCGA client
     :param study: study ID
-    :param logger: logger object to generate logs
     :param template: boolean specifying whether the annotation can be delayed
     """
 
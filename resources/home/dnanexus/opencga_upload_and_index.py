@@ -1,6 +1,8 @@
 #!/usr/bin/env python3
 
 # import required libraries
+import asyncio
+import dataclasses
 import datetime
 import os
 import sys
@@ -8,33 +10,27 @@ import json
 import logging
 import argparse
 import subprocess
-from pyopencga.opencga_client import OpencgaClient
-from pyopencga.opencga_config import ClientConfiguration
 from subprocess import PIPE
 from opencga_functions import *
 
 
-# Define logger handlers (one file for logs and one for errors)
 logger = logging.getLogger()
-logger.setLevel(logging.DEBUG)
-# create file handler which logs INFO messages
-oh = logging.FileHandler('opencga_loader.out')
-oh.setLevel(logging.DEBUG)
-# create file handler which logs ERROR messages
-eh = logging.FileHandler('opencga_loader.err')
-eh.setLevel(logging.ERROR)
-# create stream handler which logs INFO messages
-console = logging.StreamHandler(stream=sys.stdout)
-console.setLevel(logging.INFO)
-# create formatter and add it to the handlers
-formatter = logging.Formatter('%(asctime)s - %(module)s - %(levelname)s: %(message)s')
-eh.setFormatter(formatter)
-oh.setFormatter(formatter)
-console.setFormatter(formatter)
-# add the handlers to logger
-logger.addHandler(eh)
-logger.addHandler(oh)
-logger.addHandler(console)
+
+
+# No slots=True: the applet's declared runtime (Ubuntu 20.04, Python 3.8) predates dataclass slots support
+@dataclasses.dataclass
+class FileStatus:
+    """Status of one VCF in OpenCGA, as derived from the batched file search."""
+    uploaded: bool = False
+    indexed: bool = False
+    annotated: bool = False
+    secondary_indexed: bool = False
+    catalog_path: str = None
+    sample_ids: list = None
+
+
+# Case priorities that must not have their annotation and secondary index delayed
+NO_DELAY_PRIORITIES = frozenset({'URGENT'})
 
 
 def build_variant_sample_index(oc, metadata, sample_ids):
@@ -45,64 +41,79 @@ def build_variant_sample_index(oc, metadata, sample_ids):
     :param sample_ids: list of sample IDs
     """
     variant_sample_index_job = oc.variant_operations.index_sample_genotype(study=metadata['study'], data={'sample': sample_ids})
-    logger.info("Building variant sample indices for sample(s) {} with job ID: {}".format(', '.join(sample_ids),
-                                                                        variant_sample_index_job.get_result(0)['id']))
+    job_id = variant_sample_index_job.get_result(0)['id']
+    logger.info("Building variant sample indices for sample(s) %s with job ID: %s", ', '.join(sample_ids), job_id)
     try:
+        # wait_for_job raises on failure, so a successful return means the job is DONE and no follow-up
+        # jobs.info round-trip is needed
         oc.wait_for_job(response=variant_sample_index_job.get_response(0))
-        status = oc.jobs.info(study=metadata['study'], jobs=variant_sample_index_job.get_result(0)['id'])
-        if status.get_result(0)['execution']['status']['name'] == 'DONE':
-            logger.info(
-                "OpenCGA job variant sample index completed successfully for sample(s).".format(', '.join(sample_ids)))
-        else:
-            logger.info(
-                "OpenCGA job variant sample index failed with status {}.".format(
-                    status.get_result(0)['execution']['status']['name']))
+        logger.info("OpenCGA job variant sample index completed successfully for sample(s) %s.",
+                    ', '.join(sample_ids))
     except ValueError as ve:
-        logger.exception("OpenCGA job svariant sample index failed. {}".format(ve))
-        sys.exit(0)
+        # Only fetch the job details when we need the failure reason
+        try:
+            status = oc.jobs.info(study=metadata['study'], jobs=job_id)
+            logger.error("OpenCGA job variant sample index failed with status %s.",
+                         status.get_result(0)['execution']['status']['name'])
+        except Exception:
+            logger.exception("OpenCGA job variant sample index failed. %s", ve)
+        sys.exit(1)
 
 
 if __name__ == '__main__':
+    configure_logging()
+
     # Set the arguments of the command line
     parser = argparse.ArgumentParser(description=' Index VCFs from DNANexus into OpenCGA')
     parser.add_argument('--metadata', help='Zip file containing the metadata (minimum required information: "study")')
     parser.add_argument('--credentials', help='JSON file with credentials and host to access OpenCGA')
     parser.add_argument('--cli', help='Path to OpenCGA cli')
-    parser.add_argument('--vcf', help='Input vcf file')
-    parser.add_argument('--dnanexus_fid', help='DNA nexus file ID')
+    parser.add_argument('--vcf', nargs='+', help='Input vcf file(s)')
+    parser.add_argument('--dnanexus_fid', nargs='+', help='DNA nexus file ID(s), in the same order as the VCFs')
+    parser.add_argument('--num-procs', type=int, default=6, help='Maximum number of concurrent upload processes')
+    parser.add_argument('--poll-interval-base', type=float, default=1.0,
+                        help='Initial number of seconds between job status polls')
+    parser.add_argument('--poll-interval-cap', type=float, default=30.0,
+                        help='Maximum number of seconds between job status polls')
     args = parser.parse_args()
 
     # Check the location of the OpenCGA CLI
     if not os.path.isfile(args.cli):
         logger.error("OpenCGA CLI not found.")
-        sys.exit(0)
+        sys.exit(1)
     opencga_cli = args.cli
 
     # Read metadata file
-    manifest, samples, individuals, clinical = read_metadata(metadata_file=args.metadata, logger=logger)
+    manifest, samples, individuals, clinical = read_metadata(metadata_file=args.metadata)
+    study_id = manifest['study']['id']
 
     # Read credentials file
     credentials = get_credentials(credentials_file=args.credentials)
 
     # Login OpenCGA CLI
-    connect_cli(credentials=credentials, opencga_cli=opencga_cli, logger=logger)
+    connect_cli(credentials=credentials, opencga_cli=opencga_cli)
 
     # Create pyopencga client
-    oc = connect_pyopencga(credentials=credentials, logger=logger)
+    oc = connect_pyopencga(credentials=credentials)
 
     # Get today's date to store the file in a directory named as "YearMonth" (e.g. 202112 = December 2021)
     date_folder = datetime.date.today().strftime("%Y%m")
     file_path = "data/" + date_folder
 
-    # Format DNA Nexus file ID to attributes
-    dnanexus_attributes = {"attributes": {
-                                "DNAnexusFileId": args.dnanexus_fid}}
+    # Compute each file's basename once; the loops below would otherwise re-derive it several times per file
+    vcf_names = {vcf: os.path.basename(vcf) for vcf in args.vcf}
 
-    # Get case priority. If case priority is URGENT, jobs will not be delayed
-    delay = True
-    priority = clinical[0]['priority']['id']
-    if priority == 'URGENT':
-        delay = False
+    # Format DNA Nexus file IDs to attributes, keyed by file basename. The IDs are promised in the same
+    # order as the VCFs, so a count mismatch is a fatal error rather than a silent zip truncation that
+    # would store DNAnexusFileId: None for the unmatched files
+    if len(args.dnanexus_fid or []) != len(args.vcf):
+        logger.error("Expected one DNA nexus file ID per VCF, got %d file ID(s) for %d VCF(s).",
+                     len(args.dnanexus_fid or []), len(args.vcf))
+        sys.exit(1)
+    dnanexus_fids = dict(zip(vcf_names.values(), args.dnanexus_fid))
+
+    # Get case priority. If case priority is in the no-delay set, jobs will not be delayed
+    delay = clinical[0]['priority']['id'] not in NO_DELAY_PRIORITIES
 
     # Check study to define index type
     somatic = False
@@ -111,71 +122,119 @@ if __name__ == '__main__':
         somatic = True
         multi_file = True
 
-    # Check the status of the file and execute the necessary actions
-    uploaded, indexed, annotated, secondary_indexed, file_path, sample_ids = check_file_status(oc=oc,
-                                                                 study=manifest['study']['id'],
-                                                                 file_name=os.path.basename(args.vcf),
-                                                                 attributes=dnanexus_attributes,
-                                                                 logger=logger, check_attributes=True)
-
-    # UPLOAD
-    if uploaded:
-        logger.info("File {} already exists in the OpenCGA study {}. "
-                    "Path to file: {}".format(os.path.basename(args.vcf), manifest['study']['id'], file_path))
-    else:
-        logger.info("Uploading file {} into study {}...".format(os.path.basename(args.vcf), manifest['study']['id']))
-        # upload_file(opencga_cli=opencga_cli, oc=oc, study=manifest['study']['id'], file=args.vcf, file_path=file_path,
-        #             attributes=dnanexus_attributes, logger=logger)
-
-    # INDEXING
-    if indexed:
-        logger.info("File {} is indexed in the OpenCGA study {}.".format(os.path.basename(args.vcf),
-                                                                         manifest['study']['id']))
-    else:
-        logger.info("Indexing file {} into study {}...".format(os.path.basename(args.vcf), manifest['study']['id']))
-        # index_file(oc=oc, study=manifest['study']['id'], file=os.path.basename(args.vcf), logger=logger,
-        #            somatic=somatic, multifile=multi_file)
+    # Check the status of every file with a single batched search and collect the ones that need to be uploaded
+    dnanexus_attributes = {}
+    for base in vcf_names.values():
+        dnanexus_attributes[base] = {"attributes": {"DNAnexusFileId": dnanexus_fids.get(base)}}
+    batch_statuses = check_file_status_batch(oc=oc, study=study_id,
+                                             file_names=list(vcf_names.values()),
+                                             attributes=dnanexus_attributes, check_attributes=True)
+    file_statuses = {}
+    files_to_upload = []
+    upload_attributes = {}
+    for vcf, base in vcf_names.items():
+        uploaded, indexed, annotated, secondary_indexed, catalog_path, sample_ids = batch_statuses[base]
+        file_statuses[vcf] = FileStatus(uploaded=uploaded, indexed=indexed, annotated=annotated,
+                                        secondary_indexed=secondary_indexed, catalog_path=catalog_path,
+                                        sample_ids=sample_ids)
+        if uploaded:
+            logger.info("File %s already exists in the OpenCGA study %s. Path to file: %s",
+                        base, study_id, catalog_path)
+        else:
+            files_to_upload.append(vcf)
+            upload_attributes[base] = dnanexus_attributes[base]
+
+    # Fast path for re-runs: if every file is already uploaded, indexed, annotated and Solr-indexed there is
+    # nothing left to submit, so skip the whole pipeline instead of queuing no-op jobs
+    if all(fs.uploaded and fs.indexed and fs.annotated and fs.secondary_indexed
+           for fs in file_statuses.values()):
+        logger.info("File(s) %s are already fully processed in the OpenCGA study %s. Nothing to do.",
+                    ", ".join(vcf_names.values()), study_id)
+        logging.shutdown()
+        sys.exit(0)
 
-    # Launch variant stats index
+    # UPLOAD: the missing files are split across concurrent CLI invocations driven by one event loop
+    if files_to_upload:
+        logger.info("Uploading file(s) %s into study %s...",
+                    ", ".join(vcf_names[vcf] for vcf in files_to_upload), study_id)
+        upload_files(opencga_cli=opencga_cli, oc=oc, study=study_id, files=files_to_upload,
+                     file_path=file_path, attributes=upload_attributes,
+                     max_concurrency=args.num_procs)
+
+    # INDEXING: submit one index job per file that needs it. Jobs are only submitted here; they are awaited
+    # concurrently at the end of the pipeline
+    index_job_ids = []
+    files_to_index = []
+    for vcf, base in vcf_names.items():
+        if file_statuses[vcf].indexed:
+            logger.info("File %s is indexed in the OpenCGA study %s.", base, study_id)
+        else:
+            files_to_index.append(base)
+    # run_index accepts a comma-separated file list, so the whole batch costs one job submission and one
+    # scheduling slot instead of one per file
+    if files_to_index:
+        logger.info("Indexing file(s) %s into study %s...", ", ".join(files_to_index), study_id)
+        index_job_ids.append(index_file(oc=oc, study=study_id, file=",".join(files_to_index),
+                                        somatic=somatic, multifile=multi_file))
+
+    # Launch variant stats index once the index jobs have finished
     logger.info("Launching variant stats...")
-    vsi_job = variant_stats_index(oc=oc, study=manifest['study']['id'], cohort='ALL', logger=logger)
-    # TODO: Check status of this job at the end
-
-    # ANNOTATION
-    if annotated:
-        logger.info("File {} is already annotated in the OpenCGA study {}.".format(os.path.basename(args.vcf),
-                                                                                   manifest['study']['id']))
+    vsi_job = variant_stats_index(oc=oc, study=study_id, cohort='ALL',
+                                  depends_on=index_job_ids)
+
+    # ANNOTATION: queued server-side behind the index jobs
+    annotation_job_ids = []
+    if all(file_statuses[vcf].annotated for vcf in args.vcf):
+        logger.info("File(s) %s already annotated in the OpenCGA study %s.",
+                    ", ".join(vcf_names.values()), study_id)
     else:
-        logger.info("Annotating file {} into study {}...".format(os.path.basename(args.vcf), manifest['study']['id']))
-        annotate_variants(oc=oc, study=manifest['study']['id'], logger=logger, delay=delay)
-
-    # Run sample variant stats
+        logger.info("Annotating new variants in study %s...", study_id)
+        annotation_job_ids.append(annotate_variants(oc=oc, study=study_id,
+                                                    delay=delay, depends_on=index_job_ids))
+
+    # Run sample variant stats on every sample in the batch
+    all_sample_ids = []
+    for vcf in args.vcf:
+        for sample_id in file_statuses[vcf].sample_ids or []:
+            if sample_id not in all_sample_ids:
+                all_sample_ids.append(sample_id)
     logger.info("Launching variant stats...")
-    svs_job = sample_variant_stats(oc=oc, study=manifest['study']['id'], sample_ids=sample_ids, logger=logger)
-    # TODO: Check status of this job at the end
-
-    # SECONDARY ANNOTATION INDEX
-    if secondary_indexed:
-        logger.info("File {} is already indexed in Solr in the OpenCGA study {}.".format(os.path.basename(args.vcf),
-                                                                                         manifest['study']['id']))
+    svs_job_ids = sample_variant_stats(oc=oc, study=study_id, sample_ids=all_sample_ids,
+                                       depends_on=index_job_ids)
+
+    # SECONDARY ANNOTATION INDEX: queued server-side behind the annotation (or the index jobs if no annotation
+    # was needed)
+    secondary_index_job_ids = []
+    if all(file_statuses[vcf].secondary_indexed for vcf in args.vcf):
+        logger.info("File(s) %s already indexed in Solr in the OpenCGA study %s.",
+                    ", ".join(vcf_names.values()), study_id)
     else:
-        logger.info("Updating Solr index in study {}...".format(manifest['study']['id']))
-        secondary_index(oc=oc, study=manifest['study']['id'], logger=logger)
+        logger.info("Updating Solr index in study %s...", study_id)
+        secondary_index_job_ids.append(secondary_index(oc=oc, study=study_id,
+                                                       depends_on=annotation_job_ids or index_job_ids))
 
-    # LOAD TEMPLATE
-    load_template()
+    # Wait for every submitted job with one batched poll per cycle. Dependencies are handled by the OpenCGA job
+    # scheduler, so the total wait is the critical path of the job DAG rather than the sum of the stages
+    pending_job_ids = index_job_ids + [vsi_job] + annotation_job_ids + svs_job_ids + secondary_index_job_ids
+    final_statuses = wait_for_jobs(oc=oc, study=study_id, job_ids=pending_job_ids,
+                                   base=args.poll_interval_base, cap=args.poll_interval_cap)
+
+    # LOAD TEMPLATE: load_template is still an unimplemented stub and this applet receives no template input,
+    # so the call stays disabled until the loader exists
+    #load_template(oc=oc, study=study_id, template=None)
 
     # Run variant sample index
     #build_variant_sample_index(oc=oc, metadata=metadata, sample_ids=sample_ids)
 
-    # # Check again the status of the file
-    # uploaded, indexed, annotated = check_file_status(oc=oc, config=config, file_name=os.path.basename(args.vcf))
-    # if uploaded and indexed and annotated:
-    #     logger.info("File {} has been successfully uploaded, indexed and annotated.")
-    # else:
-    #     logger.error("Something went wrong. Status of file {}:\n\t- uploaded: {}\n\t- indexed: {}\n\t- annotated: {}\n"
-    #                "Please check the logs to identify the problem.".format(args.vcf, uploaded, indexed, annotated))
+    # Summarize from the in-memory job outcomes instead of re-querying every file status from OpenCGA
+    failed_jobs = [job_id for job_id, status in final_statuses.items() if status != 'DONE']
+    if failed_jobs:
+        logger.error("Job(s) %s did not complete successfully for file(s) %s. "
+                     "Please check the logs to identify the problem.",
+                     ", ".join(failed_jobs), ", ".join(vcf_names.values()))
+    else:
+        logger.info("All %d OpenCGA jobs completed successfully for file(s) %s.",
+                    len(final_statuses), ", ".join(vcf_names.values()))
 
     # close loggers
-    oh.close()
-    eh.close()
+    logging.shutdown()